@@ -1,18 +1,29 @@
 # -*- coding: utf-8 -*-
 
 import configparser
+import gzip
 import logging
+import pickle
+import re
 import sys
-from csv import DictReader
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from glob import glob
-from os.path import basename, join
+from functools import lru_cache
+from io import TextIOWrapper
+from itertools import islice
+from locale import getpreferredencoding
+from mmap import ACCESS_READ, mmap
+from multiprocessing import get_context
+from os import fstat, makedirs, scandir, stat
+from os.path import dirname, expanduser, join
+from queue import Queue
 from sched import scheduler
 from socket import gethostname
+from threading import Thread
 
-import arrow
-from arrow.arrow import Arrow
-from influxdb import InfluxDBClient, SeriesHelper
+from influxdb import InfluxDBClient
 
 config = configparser.ConfigParser()
 config.read('config.ini')
@@ -20,148 +31,163 @@ config.read('config.ini')
 schedule = scheduler()
 
 
+def connect() -> InfluxDBClient:
+    '''Return a new client for the database in the config, to be kept so its connections stay alive'''
+    return InfluxDBClient(
+        host=config.get('database', 'host'),
+        port=config.getint('database', 'port'),
+        username=config.get('database', 'user'),
+        password=config.get('database', 'password'),
+        database=config.get('database', 'database')
+    )
+
+
+def _escape_measurement(measurement: str) -> str:
+    '''Escape a measurement name for InfluxDB line protocol'''
+    return measurement.replace(',', r'\,').replace(' ', r'\ ')
+
+
+def _escape_tag(tag: str) -> str:
+    '''Escape a tag key or value for InfluxDB line protocol, as make_lines in the pinned influxdb 5.3.1 does'''
+    return tag.replace('\\', '\\\\').replace(',', r'\,').replace(
+        ' ', r'\ ').replace('=', r'\=').replace('\n', r'\n')
+
+
 class SpeedFan:
     '''Manages importing data from SpeedFan logs'''
 
     INSTALL_KEY = r'SOFTWARE\WOW6432Node\SpeedFan'
-
-    class Temp(SeriesHelper):
-        class Meta:
-            client = None
-            series_name = '°C'
-            fields = ['value']
-            time_precision = 's'
-            tags = [
-                'metric',
-                'chipset',
-                'index',
-                'host',
-                'wanted',
-                'warning',
-                'offset',
-                'used_pwms'
-            ]
-            bulk_size = 100
-            autocommit = True
-
-    class PWM(SeriesHelper):
-        class Meta:
-            client = None
-            series_name = '%'
-            fields = ['value']
-            time_precision = 's'
-            tags = [
-                'metric',
-                'chipset',
-                'index',
-                'host',
-                'minimum',
-                'maximum',
-                'variate'
-            ]
-            bulk_size = 100
-            autocommit = True
-
-    class Fan(SeriesHelper):
-        class Meta:
-            client = None
-            series_name = 'RPM'
-            fields = ['value']
-            time_precision = 's'
-            tags = [
-                'metric',
-                'chipset',
-                'index',
-                'host'
-            ]
-            bulk_size = 100
-            autocommit = True
-
-    class Volt(SeriesHelper):
-        class Meta:
-            client = None
-            series_name = 'V'
-            fields = ['value']
-            time_precision = 's'
-            tags = [
-                'metric',
-                'chipset',
-                'index',
-                'host'
-            ]
-            bulk_size = 100
-            autocommit = True
-
-    def __init__(self, install_dir=None, hostname=None, bulk_size: int = 100):
+    CACHE_FILE = join(expanduser('~'), '.cache', 'speedfan2influx.pkl')
+    # bump when the cached settings change shape
+    CACHE_VERSION = 1
+    READ_BUFFER = 1 << 20
+    # 'xxx <type> <index> from <source>', its key=value params, then 'xxx end'
+    SENSOR_BLOCK_RE = re.compile(
+        r'^xxx (?P<type>\w+) (?P<index>\d+) from (?P<source>[^\n]*)\n(?P<params>.*?)^xxx end',
+        re.M | re.S)
+    # Integer and boolean values are split into their own groups so the
+    # match itself decides how each value is coerced
+    PARAM_RE = re.compile(r'^(\w+)=(?:(-?\d+)|(true|false)|(.*))$', re.M)
+    PARAM_LITERALS = {'true': True, 'false': False}
+    # SpeedFan sensor type: (metric type, measurement or None for the
+    # temperature units, value suffix, {tag: sensor param})
+    METRIC_TYPES = {
+        'Temp': ('temp', None, '', {
+            'wanted': 'wanted',
+            'warning': 'warning',
+            'offset': 'offset',
+            'used_pwms': 'UsedPwms'
+        }),
+        'Pwm': ('pwm', '%', '', {
+            'minimum': 'minimum',
+            'maximum': 'maximum',
+            'variate': 'variate'
+        }),
+        # integer field, to match the existing series
+        'Fan': ('fan', 'RPM', 'i', {}),
+        'Volt': ('volt', 'V', '', {})
+    }
+
+    def __init__(self, install_dir=None, hostname=None, bulk_size: int = 5000,
+                 workers: int = 4, compress: bool = True):
         if install_dir is None:
             self._dir = self._get_dir()
         else:
             self._dir = install_dir
-        self._params = self._get_params()
-        self.temp_units = ('°F', '°C')[
-            self._params.getboolean('speedfan', 'UseCelsius')]
-        SpeedFan.Temp.Meta.series_name = self.temp_units
-        SpeedFan.Temp.Meta.bulk_size = bulk_size
-        SpeedFan.PWM.Meta.bulk_size = bulk_size
-        SpeedFan.Fan.Meta.bulk_size = bulk_size
-        SpeedFan.Volt.Meta.bulk_size = bulk_size
-        self.log_has_header = self._params.getboolean(
-            'speedfan', 'LogAddHeader')
+        self.bulk_size = bulk_size
+        self.workers = workers
+        self.compress = compress
         self.tzinfo = datetime.now().astimezone().tzinfo
-        self.metrics = {}
         if hostname is None:
             hostname = gethostname()
         self.hostname = hostname
+        # logfiles are parsed in worker processes, free of the GIL; spawned
+        # rather than forked, as they start while the writer thread runs
+        self._pool = ProcessPoolExecutor(
+            max_workers=workers, mp_context=get_context('spawn'))
+        self._load_config()
+        self._emit_plan = self._plan_emit(self.header)
+
+    def __getstate__(self) -> dict:
+        '''Leave out the pool when sent to a worker process'''
+        state = self.__dict__.copy()
+        del state['_pool']
+        return state
+
+    def close(self):
+        '''Shut down the worker processes'''
+        self._pool.shutdown()
+
+    def _load_config(self):
+        '''Load the SpeedFan settings, from the cache unless its cfg files have changed'''
+        logger = logging.getLogger('Speedfan')
+        key = (self.CACHE_VERSION, self._dir, self.hostname)
+        mtimes = tuple(stat(join(self._dir, cfg)).st_mtime_ns
+                       for cfg in ('speedfanparams.cfg', 'speedfansens.cfg'))
+        try:
+            with open(self.CACHE_FILE, 'rb') as cache_file:
+                cache = pickle.load(cache_file)
+        except (OSError, EOFError, pickle.PickleError):
+            cache = {}
+        if key in cache and cache[key][0] == mtimes:
+            logger.debug(f'Using cached settings from {self.CACHE_FILE}')
+            (_, self.temp_units, self.log_has_header,
+             self.header, self.metrics) = cache[key]
+            return
+
+        params = self._get_params()
+        self.temp_units = ('°F', '°C')[
+            params.get('usecelsius', 'false').lower() == 'true']
+        self.log_has_header = params.get(
+            'logaddheader', 'false').lower() == 'true'
+        self.metrics = {}
         self.header = ['Seconds']
         self._get_metrics()
 
-    def _get_dir(self) -> str:
-        '''Return the install directory of SpeedFan from the Windows Registry'''
+        cache[key] = (mtimes, self.temp_units, self.log_has_header,
+                      self.header, self.metrics)
+        try:
+            makedirs(dirname(self.CACHE_FILE), exist_ok=True)
+            with open(self.CACHE_FILE, 'wb') as cache_file:
+                pickle.dump(cache, cache_file)
+        except OSError as e:
+            logger.warning(f'Could not cache settings in {self.CACHE_FILE}: {e}')
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _get_dir() -> str:
+        '''Return the install directory of SpeedFan from the Windows Registry, looked up once per process'''
         import winreg
-        hndl = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, self.INSTALL_KEY)
-        return winreg.QueryValue(hndl, None)
-
-    def _get_params(self) -> configparser.ConfigParser:
-        '''Return a ConfigParser for the SpeedFan program options, with one section called 'speedfan' '''
-        params = '[speedfan]\n' + \
-            open(join(self._dir, 'speedfanparams.cfg')).read()
-        speedfan = configparser.ConfigParser()
-        speedfan.read_string(params)
-        return speedfan
-
-    def _parse_metric_block(self, block: str) -> tuple:
-        '''Process a metric block to return its contents'''
-        header, *param_block = block.replace('xxx', '').strip().split('\n')
-
-        metric_index, source = header.split(' from ')
-        metric_type, index = metric_index.split(' ')
-        index = int(index)
-
-        params = {}
-        for param in param_block:
-            key, value = param.split('=')
-            if value == 'true':
-                value = True
-            elif value == 'false':
-                value = False
-            else:
-                try:
-                    value = int(value)
-                except ValueError:
-                    pass
-            params[key] = value
-        return source, metric_type, index, params
+        with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, SpeedFan.INSTALL_KEY) as hndl:
+            return winreg.QueryValue(hndl, None)
+
+    def _get_params(self) -> dict:
+        '''Return the SpeedFan program options as strings, keyed by lowercase name like ConfigParser'''
+        with open(join(self._dir, 'speedfanparams.cfg')) as params_file:
+            params = params_file.read()
+        return {key.strip().lower(): value.strip()
+                for key, sep, value in (line.partition('=') for line in params.splitlines())
+                if sep}
+
+    def _parse_metric_blocks(self, sensors: str):
+        '''Yield the source, type, index and params of each metric block in the sensor config'''
+        for block in self.SENSOR_BLOCK_RE.finditer(
+                sensors, sensors.index('xxx the end')):
+            params = {}
+            for key, number, literal, text in self.PARAM_RE.findall(block['params']):
+                if number:
+                    params[key] = int(number)
+                elif literal:
+                    params[key] = self.PARAM_LITERALS[literal]
+                else:
+                    params[key] = text
+            yield block['source'], block['type'], int(block['index']), params
 
     def _get_metrics(self):
         '''Record which metrics SpeedFan is logging'''
-        sens_blocks = open(join(self._dir, 'speedfansens.cfg')).read().split(
-            'xxx the end')[1].strip().split('xxx end')
-        for block in sens_blocks:
-            if not block:
-                continue
-            source, metric_type, index, params = self._parse_metric_block(
-                block)
-
+        with open(join(self._dir, 'speedfansens.cfg')) as sensors_file:
+            sensors = sensors_file.read()
+        for source, metric_type, index, params in self._parse_metric_blocks(sensors):
             if params['active'] and params['logged']:
                 # metric is logged and active, enable exporting
 
@@ -170,145 +196,220 @@ class SpeedFan:
                 self.header.append(name)
 
                 # create metric of the right type
-                if metric_type == 'Temp':
-                    metric = {
-                        'type': 'temp',
-                        'function': float,
-                        'chipset': source,
-                        'metric': name,
-                        'index': index,
-                        'units': self.temp_units,
-                        'hostname': self.hostname,
-                        'wanted': params['wanted'],
-                        'warning': params['warning'],
-                        'offset': params['offset'],
-                        'used_pwms': params['UsedPwms']
-                    }
-                elif metric_type == 'Pwm':
-                    metric = {
-                        'type': 'pwm',
-                        'function': float,
-                        'chipset': source,
-                        'metric': name,
-                        'index': index,
-                        'hostname': self.hostname,
-                        'minimum': params['minimum'],
-                        'maximum': params['maximum'],
-                        'variate': params['variate']
-                    }
-                elif metric_type == 'Fan':
-                    metric = {
-                        'type': 'fan',
-                        'function': int,
-                        'chipset': source,
-                        'metric': name,
-                        'index': index,
-                        'hostname': self.hostname
-                    }
-                elif metric_type == 'Volt':
-                    metric = {
-                        'type': 'volt',
-                        'function': float,
-                        'chipset': source,
-                        'metric': name,
-                        'index': index,
-                        'hostname': self.hostname
-                    }
-
+                type_name, units, value_suffix, param_tags = self.METRIC_TYPES[metric_type]
+                if units is None:
+                    units = self.temp_units
+                tags = {
+                    'metric': name,
+                    'chipset': source,
+                    'index': index,
+                    'host': self.hostname
+                }
+                for tag, param in param_tags.items():
+                    tags[tag] = params[param]
+                metric = {
+                    'type': type_name,
+                    'units': units,
+                    'value_suffix': value_suffix,
+                    'lp_prefix': self._line_prefix(units, tags)
+                }
                 self.metrics[name] = metric
 
-    def find_last(self, client: InfluxDBClient) -> Arrow:
-        '''Locate the last data in the database and return it as an Arrow'''
+    def _plan_emit(self, fieldnames: list) -> list:
+        '''Return the column, line protocol prefix, value suffix and type of each metric in logfile columns named `fieldnames`'''
+        return [(fieldnames.index(name), self.metrics[name]['lp_prefix'],
+                 self.metrics[name]['value_suffix'], self.metrics[name]['type'])
+                for name in self.header[1:]]
+
+    @staticmethod
+    def _line_prefix(measurement: str, tags: dict) -> str:
+        '''Return the line protocol for a point up to its value, with the tags sorted and escaped'''
+        tag_set = ''.join(
+            f',{_escape_tag(key)}={_escape_tag(str(value))}'
+            for key, value in sorted(tags.items()) if str(value))
+        return f'{_escape_measurement(measurement)}{tag_set} value='
+
+    def find_last(self, client: InfluxDBClient) -> datetime:
+        '''Locate the last data in the database and return it as a local datetime'''
         results = client.query(
-            'SELECT LAST(value) FROM "°C","°F","RPM","%","V" WHERE host=$host', bind_params={'host': self.hostname})
-        last = arrow.get(0)
-        for series in results.raw['series']:
-            series_last = arrow.get(series['values'][0][0]).to(self.tzinfo)
-            if last < series_last:
-                last = series_last
-        return last
+            'SELECT LAST(value) FROM "°C","°F","RPM","%","V" WHERE host=$host', bind_params={'host': self.hostname}, epoch='s')
+        last = max((series['values'][0][0]
+                    for series in results.raw.get('series', [])), default=0)
+        return datetime.fromtimestamp(last, self.tzinfo)
+
+    @staticmethod
+    def _bisect_rows(log: mmap, start: int, column: int, seconds: int) -> int:
+        '''Return the offset of the first row at or after `seconds`, given the rows from `start` in increasing order'''
+        def row_seconds(row_start: int) -> tuple:
+            '''Return the seconds of the first complete row from `row_start` that has them, and the offset after it'''
+            while True:
+                row_end = log.find(b'\n', row_start)
+                if row_end < 0:
+                    # row still being written by SpeedFan, treat it as the newest
+                    return None, len(log)
+                try:
+                    return int(log[row_start:row_end].split(b'\t')[column]), row_end + 1
+                except (IndexError, ValueError):
+                    # blank or short row, skipped when parsing too
+                    row_start = row_end + 1
+
+        lo, hi = start, len(log)
+        while lo < hi:
+            mid = log.find(b'\n', (lo + hi) // 2) + 1
+            if not lo < mid < hi:
+                mid = lo
+            row, after = row_seconds(mid)
+            if row is None or row >= seconds:
+                hi = mid
+            else:
+                lo = after
+        return lo
+
+    def _open_log(self, logfile: str, seconds: int) -> tuple:
+        '''Return the field names of a logfile and its lines as an open text file, starting at the first row at or after `seconds`'''
+        # SpeedFan writes in the locale encoding, as plain open() would read it
+        encoding = getpreferredencoding(False)
+        log = open(logfile, 'rb', buffering=self.READ_BUFFER)
+        fieldnames = self.header
+        try:
+            if fstat(log.fileno()).st_size:
+                with mmap(log.fileno(), 0, access=ACCESS_READ) as mapped:
+                    start = 0
+                    if self.log_has_header:
+                        start = mapped.find(b'\n') + 1
+                        if start:
+                            fieldnames = mapped[:start].decode(encoding).rstrip(
+                                '\r\n').split('\t')
+                        else:
+                            # header still being written, nothing to read yet
+                            start = len(mapped)
+                    log.seek(self._bisect_rows(
+                        mapped, start, fieldnames.index('Seconds'), seconds))
+        except BaseException:
+            log.close()
+            raise
+        return fieldnames, TextIOWrapper(log, encoding=encoding, newline='')
+
+    def _encode_batch(self, lines: list) -> bytes:
+        '''Return lines of line protocol encoded as one batch, gzipped if compressing'''
+        body = '\n'.join(lines).encode('utf-8')
+        if self.compress:
+            body = gzip.compress(body, compresslevel=1)
+        return body
+
+    def _write_queued(self, client: InfluxDBClient, batches: Queue, errors: list):
+        '''Write queued batches to Influx in order until None, skipping the rest after the first error'''
+        for body in iter(batches.get, None):
+            if errors:
+                # batches hold whole rows in time order, so nothing written
+                # after a failed batch is older than its rows; find_last
+                # would skip them for good
+                continue
+            try:
+                self._write_body(client, body)
+            except Exception as e:
+                # handed back to parse_logs to raise
+                errors.append(e)
+
+    def _write_body(self, client: InfluxDBClient, body: bytes):
+        '''POST one encoded batch of line protocol to Influx'''
+        headers = {'Content-Type': 'application/octet-stream'}
+        if self.compress:
+            headers['Content-Encoding'] = 'gzip'
+        client.request('write', method='POST',
+                       params={'db': client._database, 'precision': 's'},
+                       data=body, expected_response_code=204, headers=headers)
+
+    def _parse_logfile(self, logfile: str, last: datetime) -> tuple:
+        '''Return the points added per metric type and the encoded batches for the data in one logfile (by name) from `last` onwards'''
+        counts = {}
+        bodies = []
+        base_epoch = int(datetime.strptime(logfile[5:13], '%Y%m%d').replace(
+            tzinfo=self.tzinfo).timestamp())
+        fieldnames, log = self._open_log(
+            join(self._dir, logfile), int(last.timestamp()) - base_epoch)
+        with log:
+            if fieldnames == self.header:
+                plan = self._emit_plan
+            else:
+                plan = self._plan_emit(fieldnames)
+            seconds = fieldnames.index('Seconds')
+            # a row with no newline yet is still being written by SpeedFan, pick
+            # it up next time; a short one is blank or cut off
+            width = len(fieldnames)
+            # SpeedFan never quotes its tab separated fields, so plain splitting
+            # is enough and cheaper than the csv module
+            rows = (row for row in (line.rstrip('\r\n').split('\t')
+                                    for line in log if line.endswith('\n'))
+                    if len(row) >= width)
+            # one batch of points per chunk of rows, so only that much is
+            # held in memory at once and every batch holds whole rows
+            chunk_size = max(1, self.bulk_size // max(1, len(plan)))
+            for chunk in iter(lambda: list(islice(rows, chunk_size)), []):
+                # transpose to columns so each metric is emitted in one pass
+                columns = list(zip(*chunk))
+                epochs = [f' {base_epoch + int(second)}'
+                          for second in columns[seconds]]
+                # the value suffix and timestamp of each row, shared by every column
+                stamps = {suffix: [suffix + epoch for epoch in epochs]
+                          for suffix in {suffix for _, _, suffix, _ in plan}}
+                lines = []
+                for index, prefix, suffix, metric_type in plan:
+                    lines.extend([f'{prefix}{value}{stamp}' for value, stamp
+                                  in zip(columns[index], stamps[suffix])])
+                    counts[metric_type] = counts.get(metric_type, 0) + len(chunk)
+                # encoded per chunk, so no batch holds a row newer than one
+                # still unwritten; gzipped at the fastest level, so encoding
+                # is cheap and the batches are small to send back from the worker
+                bodies.append(self._encode_batch(lines))
+                # drop this chunk before reading the next, so two are never
+                # held at once
+                del chunk, columns, epochs, stamps, lines
+        return counts, bodies
 
     def parse_logs(self, client: InfluxDBClient, period: float = -1):
         '''Loop through all logs and write the data to Influx'''
 
-        SpeedFan.Temp.Meta.client = client
-        SpeedFan.PWM.Meta.client = client
-        SpeedFan.Fan.Meta.client = client
-        SpeedFan.Volt.Meta.client = client
         logger = logging.getLogger('Speedfan')
-        logfiles = glob(join(self._dir, 'SFLog*.csv'))
+        logfiles = sorted(entry.name for entry in scandir(self._dir)
+                          if entry.name.startswith('SFLog') and entry.name.endswith('.csv'))
         last = self.find_last(client)
+        # logfiles sort by date, so find the first one not older than the
+        # last log in database in one search
+        first = bisect_left(logfiles, f'SFLog{last.strftime("%Y%m%d")}')
+        logger.debug(f'Skipping {first} logfiles older than {last}')
+        logfiles = logfiles[first:]
         counts = {}
-        for logfile in logfiles:
-            logtime = arrow.get(basename(logfile)[5:13], 'YYYYMMDD').replace(
-                tzinfo=self.tzinfo)
-            if logtime.date() < last.date():
-                # old logfile from before the date of the last log in database, skip
-                logger.debug(f'Skipping {logfile}, older than {last}')
-                continue
-            if self.log_has_header:
-                logs = DictReader(open(logfile), delimiter='\t')
-            else:
-                logs = DictReader(open(logfile), delimiter='\t',
-                                  fieldnames=self.header)
-            for log in logs:
-                timestamp = logtime.shift(seconds=int(log['Seconds']))
-                if timestamp < last:
-                    # old row that is already in the database, skip
-                    continue
-                for name in self.header[1:]:
-                    value = self.metrics[name]['function'](log[name])
-                    dt = timestamp.to('utc').format('YYYY-MM-DDTHH:mm:ss[Z]')
-                    if self.metrics[name]['type'] not in counts:
-                        counts[self.metrics[name]['type']] = 1
-                    else:
-                        counts[self.metrics[name]['type']] += 1
-                    if self.metrics[name]['type'] == 'temp':
-                        SpeedFan.Temp(
-                            host=self.metrics[name]['hostname'],
-                            chipset=self.metrics[name]['chipset'],
-                            index=self.metrics[name]['index'],
-                            metric=self.metrics[name]['metric'],
-                            value=value,
-                            time=dt,
-                            wanted=self.metrics[name]['wanted'],
-                            warning=self.metrics[name]['warning'],
-                            offset=self.metrics[name]['offset'],
-                            used_pwms=self.metrics[name]['used_pwms']
-                        )
-
-                    elif self.metrics[name]['type'] == 'pwm':
-                        SpeedFan.PWM(
-                            host=self.metrics[name]['hostname'],
-                            chipset=self.metrics[name]['chipset'],
-                            index=self.metrics[name]['index'],
-                            metric=self.metrics[name]['metric'],
-                            value=value,
-                            time=dt,
-                            minimum=self.metrics[name]['minimum'],
-                            maximum=self.metrics[name]['maximum'],
-                            variate=self.metrics[name]['variate']
-                        )
-
-                    elif self.metrics[name]['type'] == 'fan':
-                        SpeedFan.Fan(
-                            host=self.metrics[name]['hostname'],
-                            chipset=self.metrics[name]['chipset'],
-                            index=self.metrics[name]['index'],
-                            metric=self.metrics[name]['metric'],
-                            value=value,
-                            time=dt
-                        )
-
-                    elif self.metrics[name]['type'] == 'volt':
-                        SpeedFan.Volt(
-                            host=self.metrics[name]['hostname'],
-                            chipset=self.metrics[name]['chipset'],
-                            index=self.metrics[name]['index'],
-                            metric=self.metrics[name]['metric'],
-                            value=value,
-                            time=dt
-                        )
+        # encoded batches wait here for one writer, so parsing the next
+        # logfile overlaps writing the last one and batches land in order
+        batches = Queue(maxsize=8)
+        errors = []
+        writer = Thread(target=self._write_queued,
+                        args=(client, batches, errors), daemon=True)
+        writer.start()
+        # only one logfile per worker is parsed ahead of the writer, so a
+        # backfill never holds more than that many files of batches
+        logfiles = iter(logfiles)
+        pending = deque(self._pool.submit(self._parse_logfile, logfile, last)
+                        for logfile in islice(logfiles, self.workers))
+        try:
+            while pending and not errors:
+                file_counts, bodies = pending.popleft().result()
+                for logfile in islice(logfiles, 1):
+                    pending.append(self._pool.submit(
+                        self._parse_logfile, logfile, last))
+                for metric_type, count in file_counts.items():
+                    counts[metric_type] = counts.get(metric_type, 0) + count
+                for body in bodies:
+                    batches.put(body)
+        finally:
+            for future in pending:
+                future.cancel()
+            # everything must be in the database before the next find_last
+            batches.put(None)
+            writer.join()
+        if errors:
+            raise errors[0]
         logger.info(f'Added points since {last}: {counts}')
         if period > 0:
             schedule.enter(period, 1, speedfan.parse_logs,
@@ -322,28 +423,29 @@ if __name__ == '__main__':
         format='%(asctime)s\t%(name)s\t%(levelname)s\t%(message)s\t{%(filename)s:%(funcName)s:%(lineno)d}')
     logger = logging.getLogger('MAIN')
     logger.info('Starting!')
-    influx = InfluxDBClient(
-        host=config.get('database', 'host'),
-        port=config.getint('database', 'port'),
-        username=config.get('database', 'user'),
-        password=config.get('database', 'password'),
-        database=config.get('database', 'database')
-    )
+    influx = connect()
 
     bulk_size=config.getint('database', 'bulk_size')
+    workers = config.getint('database', 'workers', fallback=4)
+    compress = config.getboolean('database', 'gzip', fallback=True)
     if len(sys.argv) > 1:
         host = sys.argv[1]
         install_dir = sys.argv[2]
         logger.info(f'Processing logs (in blocks of {bulk_size}) from {host} in {install_dir}')
         speedfan = SpeedFan(hostname=host, install_dir=install_dir,
-                            bulk_size=bulk_size)
+                            bulk_size=bulk_size, workers=workers,
+                            compress=compress)
     else:
-        speedfan = SpeedFan(bulk_size=bulk_size)
+        speedfan = SpeedFan(bulk_size=bulk_size, workers=workers,
+                            compress=compress)
         logger.info(f'Processing logs (in blocks of {bulk_size}) from {speedfan.hostname} in {speedfan._dir}')
     logger.debug(f'Got headers: {speedfan.header}')
     period = config.getfloat('schedule', 'polling_period')
     schedule.enter(period, 1, speedfan.parse_logs, argument=(influx, period))
 
-    while not schedule.empty():
-        logger.info('Tick!')
-        schedule.run()
+    try:
+        while not schedule.empty():
+            logger.info('Tick!')
+            schedule.run()
+    finally:
+        speedfan.close()